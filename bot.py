@@ -1,16 +1,33 @@
 # bot.py
 
 import asyncio
+import functools
 import logging
-from typing import List
+import re
+from typing import List, Optional
+
+try:
+    import ahocorasick
+except ImportError:
+    # C-расширение pyahocorasick не обязательно: ниже есть фолбэк на regex
+    ahocorasick = None
 
 import httpx
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
 from aiogram.types import Message
+from sqlalchemy import bindparam, select
 
 from config import BOT_TOKEN, PUBLIC_BASE_URL, HH_USER_AGENT
-from db_models import AsyncSessionLocal, User, Notification, UserRequestLog
+from db_models import (
+    AsyncSessionLocal,
+    NegotiationCursor,
+    Notification,
+    User,
+    UserRequestLog,
+    negotiation_cursor_upsert,
+    notification_insert_ignore,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -29,23 +46,134 @@ REJECTION_PATTERNS = [
     "не сможем продолжить",
 ]
 
+# Автомат Ахо-Корасик по фразам отказа: строится один раз при импорте,
+# дальше каждый текст сканируется за один проход вместо поиска каждой фразы отдельно.
+# Если pyahocorasick не установлен — одна скомпилированная альтернация из re:
+# тоже один проход по тексту, без новых зависимостей.
+if ahocorasick is not None:
+    _rejection_automaton = ahocorasick.Automaton()
+    for _pattern in REJECTION_PATTERNS:
+        _rejection_automaton.add_word(_pattern, _pattern)
+    _rejection_automaton.make_automaton()
+    _rejection_re = None
+else:
+    _rejection_automaton = None
+    _rejection_re = re.compile("|".join(re.escape(p) for p in REJECTION_PATTERNS))
+
+
+@functools.lru_cache(maxsize=8192)
+def _is_rejection(t_low: str) -> bool:
+    """
+    Похоже ли сообщение на отказ. Текст уже должен быть в нижнем регистре —
+    фразы в автомате хранятся в нижнем регистре.
+
+    Один и тот же текст попадается воркеру на каждом цикле опроса, пока
+    сообщение висит в переговорах, поэтому вердикт мемоизируется.
+    """
+    if _rejection_automaton is not None:
+        return next(_rejection_automaton.iter(t_low), None) is not None
+    return _rejection_re.search(t_low) is not None
+
+
+# Горячие запросы собираются один раз на уровне модуля: SQLAlchemy кэширует
+# скомпилированный SQL по объекту statement, так что хендлеры и воркеры не
+# платят за пересборку выражения на каждый вызов.
+SEL_USER_BY_TG = select(User).where(User.telegram_id == bindparam("tg"))
+SEL_USER_ID_BY_TG = select(User.id).where(User.telegram_id == bindparam("tg"))
+SEL_USERS_WITH_TOKEN = select(User).where(User.hh_access_token.is_not(None))
+SEL_PENDING_NOTIFICATIONS = (
+    select(
+        Notification.id,
+        Notification.text,
+        Notification.is_rejection,
+        User.telegram_id,
+        User.mute_rejections,
+    )
+    .join(User, User.id == Notification.user_id)
+    .where(Notification.sent == False)
+    .order_by(Notification.created_at)
+)
+
+
+# Кэш telegram_id -> users.id, чтобы не ходить в БД за пользователем на каждое
+# входящее сообщение. Кэшируем только найденных пользователей: отрицательный
+# результат не запоминаем, иначе пропустим создание юзера в другом процессе.
+_user_id_cache: dict[int, int] = {}
+
+
+async def get_user_id_cached(tg_id: int) -> Optional[int]:
+    """
+    users.id по telegram_id через кэш; None, если пользователь ещё не создан.
+    """
+    user_id = _user_id_cache.get(tg_id)
+    if user_id is not None:
+        return user_id
 
-async def log_user_request(tg_id: int, text: str):
     async with AsyncSessionLocal() as session:
-        from sqlalchemy import select
+        res = await session.execute(SEL_USER_ID_BY_TG, {"tg": tg_id})
+        user_id = res.scalar_one_or_none()
 
-        res = await session.execute(
-            select(User).where(User.telegram_id == tg_id)
-        )
-        user = res.scalar_one_or_none()
+    if user_id is not None:
+        _user_id_cache[tg_id] = user_id
+    return user_id
+
+
+async def get_user_by_tg(session, tg_id: int) -> Optional[User]:
+    """
+    User по telegram_id. При попадании в кэш — загрузка по первичному ключу
+    (session.get), то есть один round-trip без WHERE по telegram_id.
+    """
+    cached_id = _user_id_cache.get(tg_id)
+    if cached_id is not None:
+        user = await session.get(User, cached_id)
+        if user is not None:
+            return user
+
+    res = await session.execute(SEL_USER_BY_TG, {"tg": tg_id})
+    user = res.scalar_one_or_none()
+    if user is not None:
+        _user_id_cache[tg_id] = user.id
+    return user
 
-        req = UserRequestLog(
-            user_id=user.id if user else None,
-            telegram_id=tg_id,
-            message_text=text,
+
+# Очередь логов запросов: хендлеры не ждут записи в БД,
+# фоновый писатель вставляет пачками
+_log_queue: asyncio.Queue = asyncio.Queue(maxsize=10000)
+
+
+async def log_user_request(tg_id: int, text: str):
+    user_id = await get_user_id_cached(tg_id)
+
+    try:
+        _log_queue.put_nowait(
+            {
+                "user_id": user_id,
+                "telegram_id": tg_id,
+                "message_text": text,
+            }
         )
-        session.add(req)
-        await session.commit()
+    except asyncio.QueueFull:
+        logger.warning("Request log queue is full, dropping entry for tg_id %s", tg_id)
+
+
+async def request_log_writer():
+    """
+    Фоновый писатель логов запросов: забирает строки из _log_queue
+    и вставляет их пачками одним INSERT + commit.
+    """
+    from sqlalchemy import insert
+
+    while True:
+        batch = [await _log_queue.get()]
+        while not _log_queue.empty() and len(batch) < 500:
+            batch.append(_log_queue.get_nowait())
+
+        try:
+            async with AsyncSessionLocal() as session:
+                await session.execute(insert(UserRequestLog), batch)
+                await session.commit()
+        except Exception as e:
+            logger.exception("request_log_writer error: %s", e)
 
 
 @dp.message(Command("start"))
@@ -55,17 +183,14 @@ async def cmd_start(message: Message):
 
     # создаём пользователя, если его нет
     async with AsyncSessionLocal() as session:
-        from sqlalchemy import select
-
-        res = await session.execute(
-            select(User).where(User.telegram_id == tg_id)
-        )
-        user = res.scalar_one_or_none()
+        user = await get_user_by_tg(session, tg_id)
         if not user:
             user = User(telegram_id=tg_id)  # mute_rejections=True по умолчанию
             session.add(user)
             await session.commit()
 
+        _user_id_cache[tg_id] = user.id
+
     auth_link = f"{PUBLIC_BASE_URL}/hh/auth/start?tg_id={tg_id}"
     text = (
         "Привет! 👋\n\n"
@@ -84,12 +209,7 @@ async def cmd_settings(message: Message):
     await log_user_request(tg_id, message.text or "")
 
     async with AsyncSessionLocal() as session:
-        from sqlalchemy import select
-
-        res = await session.execute(
-            select(User).where(User.telegram_id == tg_id)
-        )
-        user = res.scalar_one_or_none()
+        user = await get_user_by_tg(session, tg_id)
         if not user:
             await message.answer("Сначала отправь /start.")
             return
@@ -126,45 +246,236 @@ async def any_message(message: Message):
 
 # === Фоновая задача: рассылка уведомлений из таблицы notifications ===
 
+# Сигнал «появились новые уведомления»: ставится в hh_messages_worker после
+# вставки, чтобы notifications_worker просыпался сразу, а не по таймеру.
+notif_ready = asyncio.Event()
+
+# Размер пула отправителей в Telegram (лимит API ~30 сообщений/с)
+_TG_SENDER_POOL = 25
+
+
 async def notifications_worker():
     """
-    Периодически забирает из БД все неотправленные уведомления и шлёт их пользователям.
+    Периодически забирает из БД неотправленные уведомления и шлёт их пользователям.
     Учитывает флаг mute_rejections.
+
+    Конвейер: продюсер стримит строки из БД в очередь, пул отправителей
+    разгребает её параллельно (порядок внутри одного чата держат per-chat
+    локи), подтверждённые id помечаются одним bulk UPDATE в конце цикла.
+    Отправка начинается с первых строк, не дожидаясь конца выборки.
     """
-    from sqlalchemy import select
+    from sqlalchemy import update
 
     while True:
         try:
-            async with AsyncSessionLocal() as session:
-                res = await session.execute(
-                    select(Notification, User)
-                    .join(User, User.id == Notification.user_id)
-                    .where(Notification.sent == False)
-                    .order_by(Notification.created_at)
-                )
-                rows: List[tuple[Notification, User]] = res.all()
+            queue: asyncio.Queue = asyncio.Queue(maxsize=500)
+            # id, которые нужно пометить отправленными (успешные отправки
+            # плюс замьюченные отказы)
+            sent_ids: List[int] = []
+            chat_locks: dict[int, asyncio.Lock] = {}
+
+            async def sender():
+                while True:
+                    notif_id, text, telegram_id = await queue.get()
+                    lock = chat_locks.setdefault(telegram_id, asyncio.Lock())
+                    async with lock:
+                        try:
+                            await bot.send_message(telegram_id, text)
+                            sent_ids.append(notif_id)
+                        except Exception as e:
+                            logger.exception("Failed to send notification: %s", e)
+                    queue.task_done()
+
+            senders = [asyncio.create_task(sender()) for _ in range(_TG_SENDER_POOL)]
+            try:
+                async with AsyncSessionLocal() as session:
+                    stream = await session.stream(
+                        SEL_PENDING_NOTIFICATIONS.execution_options(yield_per=200)
+                    )
+                    async for notif_id, text, is_rejection, telegram_id, mute_rejections in stream:
+                        # если это отказ и у юзера включено не уведомлять об отказах — просто помечаем как отправленное
+                        if is_rejection and mute_rejections:
+                            sent_ids.append(notif_id)
+                            continue
+                        await queue.put((notif_id, text, telegram_id))
+
+                await queue.join()
+            finally:
+                for task in senders:
+                    task.cancel()
+
+            if sent_ids:
+                # один UPDATE ... WHERE id IN (...) вместо N UPDATE по строке
+                async with AsyncSessionLocal() as session:
+                    await session.execute(
+                        update(Notification)
+                        .where(Notification.id.in_(sent_ids))
+                        .values(sent=True)
+                    )
+                    await session.commit()
+
+        except Exception as e:
+            logger.exception("notifications_worker error: %s", e)
 
-                for notif, user in rows:
-                    # если это отказ и у юзера включено не уведомлять об отказах — просто помечаем как отправленное
-                    if notif.is_rejection and user.mute_rejections:
-                        notif.sent = True
-                        continue
+        # ждём сигнала о новых уведомлениях; таймаут — страховка для строк,
+        # которые вставляет вебхук-процесс (hh_web) и о которых сигнала не будет
+        try:
+            await asyncio.wait_for(notif_ready.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            pass
+        notif_ready.clear()
 
-                    try:
-                        await bot.send_message(user.telegram_id, notif.text)
-                        notif.sent = True
-                    except Exception as e:
-                        logger.exception("Failed to send notification: %s", e)
 
-                await session.commit()
+# === Фоновая задача: опрос HH на новые сообщения в чатах ===
+
+# Общий HTTP-клиент к HH для всех воркеров: пул соединений, keep-alive и HTTP/2
+# вместо полного TCP+TLS рукопожатия на каждого пользователя.
+hh_client = httpx.AsyncClient(
+    timeout=10.0,
+    http2=True,
+    limits=httpx.Limits(max_connections=100),
+)
+
+# Сколько пользователей опрашиваем одновременно (чтобы не упереться в лимиты HH)
+_hh_poll_semaphore = asyncio.Semaphore(10)
+
+
+def _negotiation_has_updates(neg: dict) -> bool:
+    """
+    Показывает ли /negotiations, что в переговоре есть непрочитанное.
+    """
+    return bool(
+        neg.get("has_updates")
+        or neg.get("messages_unread_count", 0) > 0
+        or neg.get("new_messages")
+    )
+
 
+async def poll_user_messages(user: User):
+    """
+    Опрос HH по одному пользователю: список переговоров, затем сообщения
+    по всем переговорам параллельно, затем сохранение новых уведомлений.
+    """
+    async with _hh_poll_semaphore:
+        headers = {
+            "Authorization": f"Bearer {user.hh_access_token}",
+            "HH-User-Agent": HH_USER_AGENT,
+        }
+
+        # 1. список переговоров (эндпоинт см. в openapi hh: /negotiations)
+        try:
+            resp = await hh_client.get("https://api.hh.ru/negotiations", headers=headers)
+            resp.raise_for_status()
         except Exception as e:
-            logger.exception("notifications_worker error: %s", e)
+            logger.exception("Failed to fetch negotiations for user %s: %s", user.id, e)
+            return
 
-        await asyncio.sleep(5)  # интервал опроса таблицы уведомлений
+        negotiations = resp.json().get("items", [])
 
+        # сообщения тянем только по переговорам, где HH показывает обновления —
+        # у типичного пользователя почти все переговоры без новых сообщений
+        nids = [
+            nid
+            for neg in negotiations
+            if (nid := neg.get("id") or neg.get("topic_id")) and _negotiation_has_updates(neg)
+        ]
+        if not nids:
+            return
+
+        # курсоры «последнее виденное сообщение» по этим переговорам
+        async with AsyncSessionLocal() as session:
+            res_cur = await session.execute(
+                select(
+                    NegotiationCursor.negotiation_id,
+                    NegotiationCursor.last_message_id,
+                ).where(
+                    NegotiationCursor.user_id == user.id,
+                    NegotiationCursor.negotiation_id.in_(nids),
+                )
+            )
+            cursors = dict(res_cur.all())
+
+        # 2. сообщения по всем переговорам — параллельно, а не по очереди
+        responses = await asyncio.gather(
+            *[
+                hh_client.get(
+                    f"https://api.hh.ru/negotiations/{nid}/messages",
+                    headers=headers,
+                    params={"with_text_only": True},
+                )
+                for nid in nids
+            ],
+            return_exceptions=True,
+        )
+
+        candidates: dict[str, str] = {}  # msg_id -> text
+        cursor_updates = []  # сдвиги курсоров по обработанным переговорам
+        for nid, r_msgs in zip(nids, responses):
+            if isinstance(r_msgs, BaseException):
+                logger.error("Failed to fetch messages for negotiation %s: %s", nid, r_msgs)
+                continue
+            try:
+                r_msgs.raise_for_status()
+            except Exception as e:
+                logger.exception("Failed to fetch messages for negotiation %s: %s", nid, e)
+                continue
+
+            msgs = r_msgs.json().get("items", [])
+            if not msgs:
+                continue
+
+            # с прошлого цикла ничего нового — пропускаем переговор целиком
+            last_msg_id = str(msgs[-1].get("id"))
+            if cursors.get(nid) == last_msg_id:
+                continue
+            cursor_updates.append(
+                {
+                    "user_id": user.id,
+                    "negotiation_id": nid,
+                    "last_message_id": last_msg_id,
+                }
+            )
+
+            for msg in msgs:
+                msg_id = str(msg.get("id"))
+                text = (msg.get("text") or "").strip()
+                author_me = msg.get("author", {}).get("me", False)
+
+                # интересуют только входящие сообщения
+                if author_me or not text:
+                    continue
+
+                candidates[msg_id] = text
+
+        if not candidates and not cursor_updates:
+            return
+
+        new_rows = []
+        for msg_id, text in candidates.items():
+            # определяем, похоже ли на отказ по ключевым фразам
+            is_rej = _is_rejection(text.lower())
+
+            new_rows.append(
+                {
+                    "user_id": user.id,
+                    "kind": "message",
+                    "hh_object_id": msg_id,
+                    "text": f"💬 Новое сообщение на hh.ru:\n\n{text}",
+                    "is_rejection": is_rej,
+                }
+            )
+
+        async with AsyncSessionLocal() as session:
+            if new_rows:
+                # дедупликация — на стороне БД: один multi-values INSERT,
+                # уже сохранённые сообщения отбрасываются по uq_notif_dedupe
+                await session.execute(notification_insert_ignore(), new_rows)
+            if cursor_updates:
+                await session.execute(negotiation_cursor_upsert(), cursor_updates)
+            await session.commit()
+            if new_rows:
+                notif_ready.set()
 
-# === Фоновая задача: опрос HH на новые сообщения в чатах ===
 
 async def hh_messages_worker():
     """
@@ -176,93 +487,23 @@ async def hh_messages_worker():
       2. По тем, где есть непрочитанные, запрашиваем /negotiations/{nid}/messages?with_text_only=true
       3. Для каждого сообщения, которое ещё не было сохранено и не похоже на отказ —
          создаём Notification(kind="message", is_rejection=...).
-    """
-    from sqlalchemy import select
 
+    Пользователи опрашиваются параллельно (с ограничением _hh_poll_semaphore),
+    поэтому время цикла ~ max() по пользователям, а не сумма.
+    """
     while True:
         try:
             async with AsyncSessionLocal() as session:
-                res = await session.execute(
-                    select(User).where(User.hh_access_token.is_not(None))
-                )
+                res = await session.execute(SEL_USERS_WITH_TOKEN)
                 users = res.scalars().all()
 
-            for user in users:
-                if not user.hh_access_token:
-                    continue
-
-                headers = {
-                    "Authorization": f"Bearer {user.hh_access_token}",
-                    "HH-User-Agent": HH_USER_AGENT,
-                }
-
-                async with httpx.AsyncClient(timeout=10.0, headers=headers) as client:
-                    # 1. список переговоров (эндпоинт см. в openapi hh: /negotiations)
-                    try:
-                        resp = await client.get("https://api.hh.ru/negotiations")
-                        resp.raise_for_status()
-                    except Exception as e:
-                        logger.exception("Failed to fetch negotiations for user %s: %s", user.id, e)
-                        continue
-
-                    negotiations = resp.json().get("items", [])
-
-                    async with AsyncSessionLocal() as session:
-                        from sqlalchemy import select as sa_select
-
-                        for neg in negotiations:
-                            nid = neg.get("id") or neg.get("topic_id")
-                            if not nid:
-                                continue
-
-                            # 2. сообщения по переговорам
-                            try:
-                                r_msgs = await client.get(
-                                    f"https://api.hh.ru/negotiations/{nid}/messages",
-                                    params={"with_text_only": True},
-                                )
-                                r_msgs.raise_for_status()
-                            except Exception as e:
-                                logger.exception("Failed to fetch messages for negotiation %s: %s", nid, e)
-                                continue
-
-                            msgs = r_msgs.json().get("items", [])
-
-                            for msg in msgs:
-                                msg_id = str(msg.get("id"))
-                                text = (msg.get("text") or "").strip()
-                                author_me = msg.get("author", {}).get("me", False)
-
-                                # интересуют только входящие сообщения
-                                if author_me or not text:
-                                    continue
-
-                                # уже есть такое уведомление?
-                                res_notif = await session.execute(
-                                    sa_select(Notification).where(
-                                        Notification.user_id == user.id,
-                                        Notification.kind == "message",
-                                        Notification.hh_object_id == msg_id,
-                                    )
-                                )
-                                existing = res_notif.scalar_one_or_none()
-                                if existing:
-                                    continue
-
-                                # определяем, похоже ли на отказ по ключевым фразам
-                                t_low = text.lower()
-                                is_rej = any(p in t_low for p in REJECTION_PATTERNS)
-
-                                notif = Notification(
-                                    user_id=user.id,
-                                    kind="message",
-                                    hh_object_id=msg_id,
-                                    text=f"💬 Новое сообщение на hh.ru:\n\n{text}",
-                                    is_rejection=is_rej,
-                                )
-                                session.add(notif)
-
-                        await session.commit()
+            results = await asyncio.gather(
+                *[poll_user_messages(user) for user in users],
+                return_exceptions=True,
+            )
+            for user, result in zip(users, results):
+                if isinstance(result, BaseException):
+                    logger.error("Polling failed for user %s: %s", user.id, result)
 
         except Exception as e:
             logger.exception("hh_messages_worker error: %s", e)
@@ -275,6 +516,7 @@ async def main():
     # поднимаем фоновые воркеры
     asyncio.create_task(notifications_worker())
     asyncio.create_task(hh_messages_worker())
+    asyncio.create_task(request_log_writer())
 
     # запускаем бота (polling)
     await dp.start_polling(bot)
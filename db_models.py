@@ -11,12 +11,17 @@ from sqlalchemy import (
     Boolean,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     JSON,
     String,
     Text,
+    UniqueConstraint,
     func,
+    text,
 )
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
@@ -34,7 +39,7 @@ class User(Base):
     telegram_id: Mapped[int] = mapped_column(BigInteger, unique=True, index=True)
 
     # из HH
-    hh_user_id: Mapped[Optional[str]] = mapped_column(String(64), index=True, nullable=True)
+    hh_user_id: Mapped[Optional[str]] = mapped_column(String(64), unique=True, index=True, nullable=True)
     hh_access_token: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     hh_refresh_token: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     hh_expires_at: Mapped[Optional[dt.datetime]] = mapped_column(
@@ -72,6 +77,23 @@ class Notification(Base):
     """
 
     __tablename__ = "notifications"
+    __table_args__ = (
+        # дедупликация на уровне БД: повторная вставка того же события —
+        # это ON CONFLICT DO NOTHING, а не SELECT-then-INSERT с гонкой
+        UniqueConstraint("user_id", "kind", "hh_object_id", name="uq_notif_dedupe"),
+        # под дедупликацию в hh_messages_worker:
+        # WHERE user_id = ? AND kind = ? AND hh_object_id IN (...)
+        Index("ix_notif_user_kind_obj", "user_id", "kind", "hh_object_id"),
+        # частичный индекс под опрос notifications_worker:
+        # WHERE sent = false ORDER BY created_at — размер O(неотправленных),
+        # а не O(всей таблицы)
+        Index(
+            "ix_notif_pending",
+            "created_at",
+            postgresql_where=text("sent = false"),
+            sqlite_where=text("sent = 0"),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
@@ -81,7 +103,7 @@ class Notification(Base):
     kind: Mapped[str] = mapped_column(String(32), nullable=False)
 
     # Идентификатор сущности HH (например, message_id, topic_id, vacancy_id и т.п.)
-    hh_object_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True, index=True)
+    hh_object_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
 
     text: Mapped[str] = mapped_column(Text, nullable=False)
 
@@ -110,6 +132,31 @@ class Notification(Base):
     )
 
 
+class NegotiationCursor(Base):
+    """
+    Последнее виденное сообщение по каждому переговору пользователя —
+    чтобы hh_messages_worker не перерабатывал старые сообщения на каждом цикле.
+    """
+
+    __tablename__ = "negotiation_cursors"
+    __table_args__ = (
+        UniqueConstraint("user_id", "negotiation_id", name="uq_neg_cursor"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
+    negotiation_id: Mapped[str] = mapped_column(String(128), nullable=False)
+    last_message_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+
+    updated_at: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=func.now(),
+        onupdate=func.now(),
+    )
+
+
 class UserRequestLog(Base):
     """
     Логи всех запросов пользователя боту.
@@ -156,9 +203,63 @@ class LogEvent(Base):
     )
 
 
+def notification_insert_ignore():
+    """
+    INSERT в notifications с ON CONFLICT DO NOTHING по uq_notif_dedupe.
+    Дедупликация делается самой БД за один round-trip, без гонок между
+    параллельными воркерами. Диалект выбираем по настроенному движку.
+    """
+    if "postgresql" in DATABASE_URL_ASYNC:
+        stmt = pg_insert(Notification)
+    else:
+        stmt = sqlite_insert(Notification)
+    return stmt.on_conflict_do_nothing(index_elements=["user_id", "kind", "hh_object_id"])
+
+
+def negotiation_cursor_upsert():
+    """
+    INSERT в negotiation_cursors с ON CONFLICT DO UPDATE по uq_neg_cursor:
+    курсор переговора либо создаётся, либо сдвигается на новое сообщение.
+    """
+    if "postgresql" in DATABASE_URL_ASYNC:
+        stmt = pg_insert(NegotiationCursor)
+    else:
+        stmt = sqlite_insert(NegotiationCursor)
+    return stmt.on_conflict_do_update(
+        index_elements=["user_id", "negotiation_id"],
+        set_={
+            "last_message_id": stmt.excluded.last_message_id,
+            "updated_at": func.now(),
+        },
+    )
+
+
 # === async engine / session ===
 
-async_engine = create_async_engine(DATABASE_URL_ASYNC, echo=False, future=True)
+_engine_kwargs: dict = {"echo": False, "future": True}
+if DATABASE_URL_ASYNC.startswith("postgresql"):
+    # пул под несколько воркеров и вебхуки; pre_ping отсекает умершие коннекты
+    _engine_kwargs.update(
+        pool_size=20,
+        max_overflow=20,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+    )
+
+async_engine = create_async_engine(DATABASE_URL_ASYNC, **_engine_kwargs)
+
+if async_engine.dialect.name == "sqlite":
+    from sqlalchemy import event
+
+    @event.listens_for(async_engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL позволяет читать параллельно с писателем вместо глобальной блокировки
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+
 AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
 
 
@@ -5,7 +5,7 @@ import logging
 from typing import Any, Dict
 
 import httpx
-from fastAPI import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import PlainTextResponse, RedirectResponse
 from pydantic import BaseModel
 
@@ -16,13 +16,27 @@ from config import (
     HH_WEBHOOK_URL,
     HH_USER_AGENT,
 )
-from db_models import AsyncSessionLocal, User, Notification, LogEvent
+from db_models import AsyncSessionLocal, User, LogEvent, notification_insert_ignore
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 app = FastAPI(title="HH OAuth & Webhook service")
 
+# Общий клиент к api.hh.ru: keep-alive + HTTP/2 вместо нового TCP+TLS
+# рукопожатия на каждый вызов.
+HH_CLIENT = httpx.AsyncClient(
+    base_url="https://api.hh.ru",
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=50),
+)
+
+
+@app.on_event("shutdown")
+async def _close_hh_client():
+    await HH_CLIENT.aclose()
+
 
 # === Pydantic-схемы под вебхук ===
 
@@ -36,6 +50,10 @@ class WebhookEvent(BaseModel):
 
 # === Вспомогательные функции ===
 
+# Кэш hh_user_id -> users.id: вебхуки по одному пользователю приходят пачками,
+# SELECT по hh_user_id нужен только на первый из них.
+_hh_user_id_cache: dict[str, int] = {}
+
 async def log_event(level: str, message: str, details: dict | None = None):
     """
     Лог в отдельную таблицу log_events, чтобы не забивать консоль и не мусорить в бизнес-таблицах.
@@ -58,12 +76,11 @@ async def exchange_code_for_token(code: str) -> dict:
         "code": code,
         "redirect_uri": HH_REDIRECT_URI,
     }
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        resp = await client.post("https://api.hh.ru/token", data=data)
-        if resp.status_code >= 400:
-            await log_event("ERROR", "Failed to exchange code for token", {"status": resp.status_code, "text": resp.text})
-            raise HTTPException(status_code=500, detail="Failed to exchange code for token")
-        return resp.json()
+    resp = await HH_CLIENT.post("/token", data=data)
+    if resp.status_code >= 400:
+        await log_event("ERROR", "Failed to exchange code for token", {"status": resp.status_code, "text": resp.text})
+        raise HTTPException(status_code=500, detail="Failed to exchange code for token")
+    return resp.json()
 
 
 async def get_hh_me(access_token: str) -> dict:
@@ -75,10 +92,9 @@ async def get_hh_me(access_token: str) -> dict:
         "Authorization": f"Bearer {access_token}",
         "HH-User-Agent": HH_USER_AGENT,
     }
-    async with httpx.AsyncClient(timeout=10.0, headers=headers) as client:
-        resp = await client.get("https://api.hh.ru/me")
-        resp.raise_for_status()
-        return resp.json()
+    resp = await HH_CLIENT.get("/me", headers=headers)
+    resp.raise_for_status()
+    return resp.json()
 
 
 async def subscribe_webhooks(access_token: str):
@@ -100,11 +116,10 @@ async def subscribe_webhooks(access_token: str):
             {"type": "NEGOTIATION_EMPLOYER_STATE_CHANGE"},
         ],
     }
-    async with httpx.AsyncClient(timeout=10.0, headers=headers) as client:
-        resp = await client.post("https://api.hh.ru/webhook/subscriptions", json=body)
-        if resp.status_code >= 400:
-            await log_event("ERROR", "Failed to subscribe webhooks", {"status": resp.status_code, "text": resp.text})
-            raise HTTPException(status_code=500, detail="Failed to subscribe webhooks")
+    resp = await HH_CLIENT.post("/webhook/subscriptions", headers=headers, json=body)
+    if resp.status_code >= 400:
+        await log_event("ERROR", "Failed to subscribe webhooks", {"status": resp.status_code, "text": resp.text})
+        raise HTTPException(status_code=500, detail="Failed to subscribe webhooks")
 
 
 def is_rejection_state(to_state: str) -> bool:
@@ -180,6 +195,7 @@ async def hh_oauth_callback(
             user.hh_expires_at = dt.datetime.now(dt.timezone.utc) + dt.timedelta(seconds=expires_in)
 
         await session.commit()
+        _hh_user_id_cache[hh_user_id] = user.id
 
     await subscribe_webhooks(access_token)
     await log_event("INFO", "HH account linked", {"tg_id": tg_id, "hh_user_id": hh_user_id})
@@ -195,30 +211,31 @@ async def hh_webhook(request: Request):
     event = WebhookEvent(**data)
     await log_event("INFO", "Incoming HH webhook", {"action_type": event.action_type, "user_id": event.user_id})
 
-    # находим пользователя по hh_user_id
+    # находим пользователя по hh_user_id (через кэш, SELECT — только на промах)
     async with AsyncSessionLocal() as session:
-        from sqlalchemy import select
+        user_id = _hh_user_id_cache.get(event.user_id)
+        if user_id is None:
+            from sqlalchemy import select
 
-        res = await session.execute(
-            select(User).where(User.hh_user_id == event.user_id)
-        )
-        user = res.scalar_one_or_none()
-        if not user:
-            # неизвестный пользователь — игнорируем
-            await log_event("WARNING", "Webhook for unknown hh_user_id", {"hh_user_id": event.user_id})
-            return PlainTextResponse("unknown user", status_code=200)
+            res = await session.execute(
+                select(User.id).where(User.hh_user_id == event.user_id)
+            )
+            user_id = res.scalar_one_or_none()
+            if not user_id:
+                # неизвестный пользователь — игнорируем
+                await log_event("WARNING", "Webhook for unknown hh_user_id", {"hh_user_id": event.user_id})
+                return PlainTextResponse("unknown user", status_code=200)
+            _hh_user_id_cache[event.user_id] = user_id
 
         notif_text = ""
         kind = ""
         is_rej = False
-        hh_object_id = None
 
         if event.action_type == "NEW_RESPONSE_OR_INVITATION_VACANCY":
             kind = "invitation"
             payload = event.payload
             vacancy_id = payload.get("vacancy_id")
             resume_id = payload.get("resume_id")
-            hh_object_id = payload.get("topic_id") or payload.get("chat_id")
 
             notif_text = (
                 "📩 Новое приглашение / отклик на hh.ru\n"
@@ -235,7 +252,6 @@ async def hh_webhook(request: Request):
             vacancy_id = payload.get("vacancy_id")
             resume_id = payload.get("resume_id")
             transferred_at = payload.get("transferred_at")
-            hh_object_id = payload.get("topic_id")
 
             is_rej = is_rejection_state(str(to_state))
             notif_text = (
@@ -249,15 +265,19 @@ async def hh_webhook(request: Request):
             # другие типы событий нам неинтересны
             return PlainTextResponse("ignored", status_code=200)
 
-        # создаём запись уведомления — бот потом сам разошлёт
-        notif = Notification(
-            user_id=user.id,
-            kind=kind,
-            hh_object_id=hh_object_id,
-            text=notif_text,
-            is_rejection=is_rej,
+        # создаём запись уведомления — бот потом сам разошлёт.
+        # Дедуп по uq_notif_dedupe идёт по id самого события: topic_id тут
+        # не годится — он общий для всех изменений этапа одного переговора,
+        # и следующий этап (например, отказ) молча бы отбрасывался.
+        await session.execute(
+            notification_insert_ignore().values(
+                user_id=user_id,
+                kind=kind,
+                hh_object_id=event.id,
+                text=notif_text,
+                is_rejection=is_rej,
+            )
         )
-        session.add(notif)
         await session.commit()
 
     return PlainTextResponse("ok", status_code=200)